@@ -5,19 +5,43 @@ import enhancement
 import logging
 import os
 import prompt
+import publisher
 import re
 import queue
 import PIL
 import random
 import sys
 import telebot
-import textwrap
 import threading
 import time
 import torch
 import tweepy
 
 
+# Parameters that are only read at startup
+RESTART_PARAMETERS = [
+    'face_enhancer_arch',
+    'face_enhancer_model_path',
+    'image_cache_dir',
+    'premoderation',
+    'prompt_device',
+    'prompt_model_id',
+    'prompt_model_tokenizer',
+    'prompt_optimize',
+    'realesrgan_model_path',
+    'sleep_time',
+    'telegram_admin_ids',
+    'telegram_chat_id',
+    'telegram_token',
+    'telegram_turbo_chat_id',
+    'turbo_sleep_time',
+    'twitter_access_token',
+    'twitter_access_token_secret',
+    'twitter_consumer_key',
+    'twitter_consumer_secret',
+]
+
+
 @dataclasses.dataclass
 class Job:
     prompt: str
@@ -27,7 +51,7 @@ class Job:
     steps: int = 0
     image: PIL.Image.Image = None
     message_id: int = 0
-    delete_message: int = 0
+    batch: publisher.Batch = None
 
     def __post_init__(self):
         params = {}
@@ -47,11 +71,19 @@ class Bot:
         self.logger.setLevel(logging.INFO)
 
         self.cfg = config.load()
+        if self.cfg['torch_threads']:
+            torch.set_num_threads(self.cfg['torch_threads'])
+        if self.cfg['compile_cache_dir']:
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = self.cfg['compile_cache_dir']
+        self.warmup_pending = False
 
         self.prompt = prompt.Prompt(self.cfg['prompt_model_id'],
                                     self.cfg['prompt_model_tokenizer'],
                                     self.cfg['sd_model_id'],
                                     self.cfg['prompt_prefix'],
+                                    self.cfg['prompt_device'],
+                                    self.cfg['prompt_optimize'],
+                                    self.cfg['prompt_batch_size'],
                                     )
         self.enhancement = enhancement.Enhancement(self.cfg['face_enhancer_model_path'],
                                                    self.cfg['face_enhancer_arch'],
@@ -80,6 +112,14 @@ class Bot:
         else:
             self.twitter_api_v1 = None
 
+        self.publisher = publisher.Publisher(self.bot,
+                                             self.cfg['image_cache_dir'],
+                                             self.twitter_api_v1,
+                                             self.twitter_client if self.twitter_api_v1 else None,
+                                             self.tw_creds.screen_name if self.twitter_api_v1 else None,
+                                             self.cfg['twitter_rate_limit'],
+                                             )
+
         self.worker_queue = queue.Queue()
 
         if not os.path.exists(self.cfg['image_cache_dir']):
@@ -94,8 +134,28 @@ class Bot:
                                        self.cfg['sd_refiner_id'],
                                        self.cfg['fp16'],
                                        self.cfg['low_vram'],
+                                       self.cfg['compile'],
                                        )
 
+    def queue_warmup(self):
+        """Queue pipeline warm-up unless one is already pending"""
+        if not self.warmup_pending:
+            self.warmup_pending = True
+            self.worker_queue.put(None)
+
+    def warmup(self):
+        """Warm up diffusion pipeline, runs in the main loop"""
+        self.warmup_pending = False
+        self.logger.info('Warming up pipeline...')
+        try:
+            load_time, timings = self.pipe.warmup([(self.cfg['image_width'], self.cfg['image_height'])])
+        except Exception as e:
+            self.logger.error('Warm-up failed: {}'.format(e))
+            return
+        self.logger.info('Pipeline loaded in {:.1f}s'.format(load_time))
+        for (width, height), (first, warm) in timings.items():
+            self.logger.info('Warm-up {}x{}: first run {:.1f}s, warm run {:.1f}s, saved {:.1f}s on the first image'.format(width, height, first, warm, first - warm))
+
     def clean_cache(self, age=86400, interval=3600):
         """Clean image cache"""
         for f in os.listdir(self.cfg['image_cache_dir']):
@@ -105,18 +165,7 @@ class Bot:
 
     def twitter_send(self, image_path, message):
         """Send image to Twitter"""
-        message = message.splitlines()[0] + '\n#AIart #stablediffusion'
-        status = textwrap.shorten(message, width=280, placeholder='...')
-        self.logger.info('Send image to Twitter...')
-        try:
-            media = self.twitter_api_v1.media_upload(image_path)
-            resp = self.twitter_client.create_tweet(text=status, media_ids=[media.media_id])
-        except Exception as e:
-            self.logger.error(e)
-        else:
-            self.logger.info("https://twitter.com/{}/status/{}".format(self.tw_creds.screen_name, resp.data['id']))
-            return True
-        return False
+        return self.publisher.twitter_send(image_path, message)
 
     def _init_commands(self):
         """Initialize methods to represent bot commands"""
@@ -140,11 +189,10 @@ class Bot:
         """Change config parameter"""
         parameter = message.text.split()[1].lower()
         value = message.text.split()[2]
-        if parameter in self.cfg:
+        if parameter in RESTART_PARAMETERS:
+            self.bot.send_message(message.chat.id, 'Parameter {} requires restart'.format(parameter))
+        elif parameter in self.cfg:
             old_value = self.cfg[parameter]
-        else:
-            old_value = None
-        if old_value:
             if type(old_value) == bool:
                 value = True if value.lower() in ['true', 'on', 'yes', '1'] else False
             elif type(old_value) == int:
@@ -154,10 +202,22 @@ class Bot:
             self.cfg[parameter] = value
             value = self.cfg[parameter]
             self.bot.send_message(message.chat.id, 'Parameter {} changed to {}'.format(parameter, value))
-            if parameter in ['sd_model_id', 'sd_model_vae_id', 'sd_refiner_id', 'fp16', 'low_vram']:
+            if parameter in ['sd_model_id', 'sd_model_vae_id', 'sd_refiner_id', 'fp16', 'low_vram', 'compile']:
                 self.logger.info('Reloading pipeline...')
                 self.__init_pipeline()
                 self.pipe.load_pipe()
+            if parameter == 'prompt_batch_size':
+                self.prompt.batch_size = value
+            if parameter == 'prompt_prefix':
+                self.prompt.prompt_prefix = value
+            if parameter == 'torch_threads' and value > 0:
+                torch.set_num_threads(value)
+            if parameter == 'twitter_rate_limit':
+                self.publisher.set_twitter_rate_limit(value)
+            if parameter == 'compile_cache_dir':
+                os.environ['TORCHINDUCTOR_CACHE_DIR'] = value
+            if self.cfg['warmup'] and parameter in ['sd_model_id', 'sd_model_vae_id', 'sd_refiner_id', 'fp16', 'low_vram', 'compile', 'image_width', 'image_height']:
+                self.queue_warmup()
         else:
             self.bot.send_message(message.chat.id, 'Parameter {} not found'.format(parameter))
 
@@ -167,23 +227,42 @@ class Bot:
         if prompt == "":
             self.bot.send_message(message.chat.id, 'Please provide a prompt')
         else:
-            batch = re.findall(r'batch=(\d+)', prompt)
-            if batch:
-                batch = int(batch[0])
+            batch_size = re.findall(r'batch=(\d+)', prompt)
+            if batch_size:
+                batch_size = int(batch_size[0])
                 prompt = re.sub(r'batch=(\d+)', '', prompt).strip()
             else:
-                batch = 1
-            for i in range(batch):
+                batch_size = 1
+            if batch_size < 1:
+                self.bot.send_message(message.chat.id, 'Batch size must be positive')
+                return
+            jobs = []
+            for i in range(batch_size):
                 if not prompt or prompt.endswith('+'):
-                    job = Job(self.prompt.generate(prompt.removesuffix('+'), random_prompt_probability=self.cfg['random_prompt_probability']), message.chat.id)
+                    job_prompt = self.prompt.generate(prompt.removesuffix('+'), random_prompt_probability=self.cfg['random_prompt_probability'])
+                    if not job_prompt:
+                        self.logger.warning('Prompt generation failed')
+                        continue
                 else:
-                    job = Job(prompt, message.chat.id)
+                    job_prompt = prompt
+                job = Job(job_prompt, message.chat.id)
                 job.seed += i
+                jobs.append(job)
+            if not jobs:
+                self.bot.send_message(message.chat.id, 'Prompt generation failed')
+                return
+            batch = publisher.Batch(len(jobs), message.chat.id, album=self.cfg['telegram_albums'])
+            prompts = []
+            for job in jobs:
+                job.batch = batch
                 self.worker_queue.put(job)
-                if prompt != job.prompt or i == batch - 1:
-                    time.sleep(0.1)
-                    msg = self.bot.send_message(message.chat.id, 'Put prompt <code>{}</code> in queue: {}'.format(job.prompt, self.worker_queue.qsize()), disable_notification=True)
-                    job.delete_message = msg.message_id
+                if job.prompt not in prompts:
+                    prompts.append(job.prompt)
+            if len(prompts) == 1:
+                status = 'Put prompt <code>{}</code> in queue: {}'.format(prompts[0], self.worker_queue.qsize())
+            else:
+                status = 'Put {} prompts in queue: {}\n{}'.format(len(prompts), self.worker_queue.qsize(), '\n'.join('<code>{}</code>'.format(p) for p in prompts))
+            self.publisher.send_status(batch, status)
 
     def _file_update_command(self, message):
         """Update txt file"""
@@ -267,6 +346,9 @@ class Bot:
         """Main loop for image generation"""
         while True:
             job = self.worker_queue.get()
+            if job is None:
+                self.warmup()
+                continue
             is_admin_chat = int(job.target_chat) in self.cfg['telegram_admin_ids']
             is_turbo_mode = job.target_chat == self.cfg['telegram_turbo_chat_id']
             self.logger.info('Generating image for prompt: {} (seed={} scale={} steps={})'.format(job.prompt, job.seed, job.scale, job.steps))
@@ -318,31 +400,10 @@ class Bot:
                     markup.add(*buttons, row_width=len(buttons))
                 else:
                     markup = None
-                self.logger.info('Send image to Telegram...')
-                message = '<code>{}</code>\nseed: <code>{}</code> | scale: <code>{}</code> | steps: <code>{}</code>'.format(job.prompt, job.seed, job.scale, job.steps)
-                try:
-                    resp = self.bot.send_photo(job.target_chat, photo=job.image, caption=message, reply_markup=markup)
-                except Exception as e:
-                    self.logger.error(e)
-                else:
-                    if resp.id:
-                        self.logger.info("https://t.me/{}/{}".format(resp.chat.username, resp.message_id))
-                        job.message_id = resp.message_id
-                        image_path = os.path.join(self.cfg['image_cache_dir'], '{}.jpg'.format(job.message_id))
-                        if not os.path.exists(image_path):
-                            job.image.save(image_path)
-                    else:
-                        self.logger.error(resp)
-            if job.message_id and not is_admin_chat and not is_turbo_mode:
-                image_path = os.path.join(self.cfg['image_cache_dir'], '{}.jpg'.format(job.message_id))
-                if self.twitter_api_v1:
-                    if not self.twitter_send(image_path, job.prompt):
-                        self.logger.error('Error posting to Twitter')
-            if not is_admin_chat and not job.message_id:
-                self.worker_queue.put(job)
-            else:
-                if job.delete_message:
-                    self.bot.delete_message(job.target_chat, job.delete_message)
+                self.publisher.publish(job, markup,
+                                       twitter=not is_admin_chat and not is_turbo_mode,
+                                       retry=not is_admin_chat,
+                                       )
 
     def run(self):
         """Start bot"""
@@ -350,6 +411,9 @@ class Bot:
         if hasattr(self.pipe, 'device'):
             self.logger.info('Used device: {}'.format(self.pipe.device))
         self.clean_cache()
+        self.publisher.start()
+        if self.cfg['warmup']:
+            self.queue_warmup()
         user = self.bot.get_me()
         if len(sys.argv) > 1:
             self.worker_queue.put(Job(sys.argv[1], self.cfg['telegram_chat_id']))
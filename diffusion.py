@@ -8,6 +8,7 @@ import random
 import torch
 import sys
 import threading
+import time
 
 
 class Pipeline:
@@ -19,6 +20,7 @@ class Pipeline:
                  sd_refiner_id: str = None,
                  fp16: bool = False,
                  low_vram: bool = False,
+                 torch_compile: bool = False,
                  ):
         self.device = torch.device('cuda' if torch.cuda.is_available(
         ) else 'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -35,6 +37,12 @@ class Pipeline:
         if self.low_vram:
             torch.backends.cudnn.benchmark = True
             torch.backends.cuda.matmul.allow_tf32 = True
+        self.torch_compile = torch_compile and hasattr(torch, 'compile')
+        if torch_compile and not self.torch_compile:
+            logging.warning('torch.compile is not available, using eager mode')
+        if self.torch_compile and self.low_vram:
+            logging.warning('torch.compile is not compatible with model CPU offload, using eager mode')
+            self.torch_compile = False
 
     def __init_pipeline(self, model_id, vae=None):
         '''Initialize the pipeline'''
@@ -71,8 +79,27 @@ class Pipeline:
             pipe.enable_model_cpu_offload()
         else:
             pipe.to(self.device)
+        if self.torch_compile:
+            self.__compile_pipeline(pipe)
         return pipe
 
+    def __compile_pipeline(self, pipe):
+        '''Use channels-last memory format and compiled kernels for the UNet and VAE'''
+        mode = 'reduce-overhead' if self.device.type == 'cuda' else None
+        if getattr(pipe, 'unet', None):
+            pipe.unet.to(memory_format=torch.channels_last)
+            pipe.unet = torch.compile(pipe.unet, mode=mode)
+        if getattr(pipe, 'vae', None):
+            pipe.vae.to(memory_format=torch.channels_last)
+            pipe.vae.decode = torch.compile(pipe.vae.decode, mode=mode)
+
+    def __uncompile_pipeline(self, pipe):
+        '''Return to eager execution'''
+        if hasattr(getattr(pipe, 'unet', None), '_orig_mod'):
+            pipe.unet = pipe.unet._orig_mod
+        if 'decode' in getattr(getattr(pipe, 'vae', None), '__dict__', {}):
+            del pipe.vae.decode
+
     def load_pipe(self):
         self.pipe = self.__init_pipeline(
             self.sd_model_id, vae=self.sd_model_vae_id)
@@ -96,6 +123,27 @@ class Pipeline:
             torch.clear_autocast_cache()
         gc.collect()
 
+    def warmup(self, resolutions, steps=2):
+        '''Run short generations to compile kernels and allocate memory before the first request.
+        Must be called from the generation thread, CUDA graphs are recorded per thread.
+        Returns model load duration and first and warm run durations for each resolution'''
+        start = time.perf_counter()
+        with self.lock:
+            if not hasattr(self, 'pipe'):
+                self.load_pipe()
+            if self.sd_refiner_id and not self.low_vram and not hasattr(self, 'refiner'):
+                self.load_refiner()
+        load_time = time.perf_counter() - start
+        timings = {}
+        for width, height in resolutions:
+            durations = []
+            for _ in range(2):
+                start = time.perf_counter()
+                self.generate('warmup', seed=1, steps=steps, width=width, height=height)
+                durations.append(time.perf_counter() - start)
+            timings[(width, height)] = tuple(durations)
+        return load_time, timings
+
     def __del__(self):
         '''Unload the pipeline and refiner'''
         self.unload_pipe()
@@ -103,8 +151,6 @@ class Pipeline:
 
     def generate(self, prompt, negative_prompt='', seed=0, scale=7.5, steps=50, width=512, height=512):
         '''Generate an image for the given prompt'''
-        if not hasattr(self, 'pipe'):
-            self.load_pipe()
         if not negative_prompt:
             negative_prompt = get_negative_prompt()
         seed = seed or random.SystemRandom().randint(0, 2**32 - 1)
@@ -113,32 +159,19 @@ class Pipeline:
             output_type = 'latent'
         try:
             self.lock.acquire()
-            generator = torch.Generator(device=self.device).manual_seed(int(seed))
-            image = self.pipe(
-                prompt,
-                negative_prompt=negative_prompt,
-                num_inference_steps=steps,
-                guidance_scale=scale,
-                output_type=output_type,
-                generator=generator,
-                width=width,
-                height=height,
-            ).images[0]
-            if self.sd_refiner_id:
-                if self.low_vram:
-                    self.unload_pipe()
-                if not hasattr(self, 'refiner'):
-                    self.load_refiner()
-                image = self.refiner(
-                    prompt=prompt,
-                    image=image,
-                    negative_prompt=negative_prompt,
-                    num_inference_steps=steps,
-                    guidance_scale=scale,
-                    generator=generator,
-                    width=width,
-                    height=height,
-                ).images[0]
+            if not hasattr(self, 'pipe'):
+                self.load_pipe()
+            try:
+                image = self.__generate(prompt, negative_prompt, seed, scale, steps, width, height, output_type)
+            except torch._dynamo.exc.TorchDynamoException as e:
+                if not self.torch_compile:
+                    raise
+                logging.error('Compilation failed, falling back to eager mode: {}'.format(e))
+                self.torch_compile = False
+                self.__uncompile_pipeline(self.pipe)
+                if getattr(self, 'refiner', None):
+                    self.__uncompile_pipeline(self.refiner)
+                image = self.__generate(prompt, negative_prompt, seed, scale, steps, width, height, output_type)
         finally:
             if self.low_vram:
                 self.unload_refiner()
@@ -149,6 +182,36 @@ class Pipeline:
         image.info['steps'] = steps
         return image
 
+    def __generate(self, prompt, negative_prompt, seed, scale, steps, width, height, output_type):
+        '''Run the pipeline and the refiner, must be called with the lock held'''
+        generator = torch.Generator(device=self.device).manual_seed(int(seed))
+        image = self.pipe(
+            prompt,
+            negative_prompt=negative_prompt,
+            num_inference_steps=steps,
+            guidance_scale=scale,
+            output_type=output_type,
+            generator=generator,
+            width=width,
+            height=height,
+        ).images[0]
+        if self.sd_refiner_id:
+            if self.low_vram:
+                self.unload_pipe()
+            if not hasattr(self, 'refiner'):
+                self.load_refiner()
+            image = self.refiner(
+                prompt=prompt,
+                image=image,
+                negative_prompt=negative_prompt,
+                num_inference_steps=steps,
+                guidance_scale=scale,
+                generator=generator,
+                width=width,
+                height=height,
+            ).images[0]
+        return image
+
 
 def get_negative_prompt(filename='negative.txt'):
     if os.path.exists(filename):
@@ -1,23 +1,56 @@
+from transformers.pytorch_utils import Conv1D
 import random
 import re
 import string
 import sys
+import torch
 import transformers
 
 
 class Prompt:
-    def __init__(self, prompt_model_id, prompt_model_tokenizer, sd_model_id, prompt_prefix='') -> None:
+    def __init__(self, prompt_model_id, prompt_model_tokenizer, sd_model_id, prompt_prefix='',
+                 device='cpu', optimize=True, batch_size=4) -> None:
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available(
+        ) else 'mps' if torch.backends.mps.is_available() else 'cpu'))
+        torch_dtype = None
+        if optimize and self.device.type in ['cuda', 'mps']:
+            torch_dtype = torch.float16
+        model = transformers.AutoModelForCausalLM.from_pretrained(prompt_model_id, torch_dtype=torch_dtype)
+        model.eval()
+        if optimize and self.device.type == 'cpu':
+            model = quantize(model)
         self.gpt2_pipe = transformers.pipeline(
             'text-generation',
-            model=prompt_model_id,
+            model=model,
             tokenizer=prompt_model_tokenizer,
+            device=self.device,
         )
+        self.batch_size = batch_size
         self.tokenizer = transformers.CLIPTokenizer.from_pretrained(sd_model_id, subfolder='tokenizer')
         self.prompt_prefix = prompt_prefix
         self.used_ideas = []
 
-    def token_count(self, prompt):
-        return self.tokenizer(prompt, return_tensors='pt')['input_ids'].shape[-1]
+    def token_counts(self, prompts):
+        return [len(ids) for ids in self.tokenizer(prompts)['input_ids']]
+
+    def sample(self, starting_text, max_length, ignores):
+        '''Sample responses and drop the unusable ones before token counting'''
+        with torch.inference_mode():
+            results = self.gpt2_pipe(starting_text,
+                                     max_length=max_length,
+                                     num_return_sequences=self.batch_size,
+                                     pad_token_id=self.gpt2_pipe.tokenizer.eos_token_id,
+                                     )
+        candidates = []
+        for r in results:
+            resp = r['generated_text'].strip()
+            if resp and resp != starting_text and len(resp) > (len(starting_text) * 2) and not resp.endswith((':', '-', '—')) and not resp.find('--'):
+                continue
+            if not any([i.lower() in resp.lower() for i in ignores]):
+                candidates.append(resp)
+        if not candidates:
+            return []
+        return [resp for resp, count in zip(candidates, self.token_counts(candidates)) if count <= 77]
 
     def generate(self, starting_text='', max_length=100, random_prompt_probability=0.5):
         transformers.set_seed(random.SystemRandom().randint(100, 1000000))
@@ -45,14 +78,7 @@ class Prompt:
             if tries > 10:
                 print('ERROR: Could not find a prompt!')
                 return
-            responses = []
-            for r in self.gpt2_pipe(starting_text, max_length=random.randint(60, max_length), num_return_sequences=4):
-                resp = r['generated_text'].strip()
-                if resp and resp != starting_text and len(resp) > (len(starting_text) * 2) and not resp.endswith((':', '-', '—')) and not resp.find('--'):
-                    continue
-                if not any([i.lower() in resp.lower() for i in ignores]) and self.token_count(resp) <= 77:
-                    responses.append(resp)
-            for r in responses:
+            for r in self.sample(starting_text, random.randint(60, max_length), ignores):
                 response_end = r.strip(string.punctuation)
                 response_end = response_end.encode('ascii', 'ignore').decode('ascii')
                 response_end = re.sub(r'[^ ]+\.[^ ]+','', response_end)
@@ -74,6 +100,19 @@ class Prompt:
         return prompt
 
 
+def quantize(model):
+    '''Apply dynamic int8 quantization to the linear layers of the model'''
+    for name, module in list(model.named_modules()):
+        if isinstance(module, Conv1D):
+            # GPT-2 uses Conv1D layers which are not supported by dynamic quantization
+            linear = torch.nn.Linear(module.weight.shape[0], module.weight.shape[1])
+            linear.weight = torch.nn.Parameter(module.weight.t().contiguous())
+            linear.bias = module.bias
+            parent_name, _, child_name = name.rpartition('.')
+            setattr(model.get_submodule(parent_name), child_name, linear)
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
 if __name__ == '__main__':
     starting_text = ''
     if len(sys.argv) > 1:
@@ -0,0 +1,389 @@
+import collections
+import dataclasses
+import itertools
+import logging
+import os
+import telebot
+import textwrap
+import threading
+import time
+import tweepy
+
+
+# Telegram Bot API limits: ~30 messages per second overall, 1 message per second
+# to the same chat and 20 messages per minute to the same group or channel
+TELEGRAM_GLOBAL_LIMITS = [(30, 1)]
+TELEGRAM_CHAT_LIMITS = [(1, 1)]
+TELEGRAM_GROUP_LIMITS = [(20, 60)]
+# Telegram accepts 2-10 photos in one media group
+TELEGRAM_ALBUM_SIZE = 10
+# Fallback pause when Twitter reports rate limit without reset header
+TWITTER_DEFAULT_BACKOFF = 900
+
+
+@dataclasses.dataclass
+class Batch:
+    '''Jobs created by one generate command'''
+    size: int
+    target_chat: str
+    album: bool = False
+    jobs: list = dataclasses.field(default_factory=list)
+    albums: list = dataclasses.field(default_factory=list)
+    published: int = 0
+    status_message: int = 0
+
+    def __post_init__(self):
+        if self.album and self.size > 1:
+            # split evenly so that every album holds at least 2 photos, e.g. 11 -> 6 + 5
+            count = -(-self.size // TELEGRAM_ALBUM_SIZE)
+            self.albums = [self.size // count + (i < self.size % count) for i in range(count)]
+
+
+@dataclasses.dataclass(order=True)
+class Task:
+    '''Scheduled API call'''
+    due: float
+    seq: int
+    api: str = dataclasses.field(compare=False)
+    key: str = dataclasses.field(compare=False)
+    send: callable = dataclasses.field(compare=False)
+    cost: int = dataclasses.field(default=1, compare=False)
+    on_success: callable = dataclasses.field(default=None, compare=False)
+    on_error: callable = dataclasses.field(default=None, compare=False)
+    expires: float = dataclasses.field(default=None, compare=False)
+    name: str = dataclasses.field(default=None, compare=False)
+
+
+class RateLimiter:
+    '''Sliding window rate limiter with per-key budgets and retry_after blocking'''
+
+    def __init__(self, limits=None):
+        self.history = collections.defaultdict(collections.deque)
+        self.blocked = {}
+        self.lock = threading.Lock()
+        self.set_limits(limits)
+
+    def set_limits(self, limits=None):
+        '''Replace the budgets keeping the call history and blocks'''
+        with self.lock:
+            self.limits = limits or []
+            self.horizon = max([period for _, period in self.limits], default=0)
+
+    def delay(self, key=None, cost=1):
+        '''Return seconds to wait before cost calls can be made for key'''
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked.get(key, now) - now
+            history = self.history[key]
+            for count, period in self.limits:
+                recent = [t for t in history if t > now - period]
+                excess = len(recent) + min(cost, count) - count
+                if excess > 0:
+                    wait = max(wait, recent[excess - 1] + period - now)
+            return max(wait, 0)
+
+    def consume(self, key=None, cost=1):
+        '''Record cost calls for key'''
+        with self.lock:
+            now = time.monotonic()
+            history = self.history[key]
+            history.extend([now] * cost)
+            while history and history[0] <= now - self.horizon:
+                history.popleft()
+
+    def block(self, key=None, seconds=0):
+        '''Block key for the given number of seconds'''
+        with self.lock:
+            self.blocked[key] = max(self.blocked.get(key, 0), time.monotonic() + seconds)
+
+
+class Publisher:
+    '''Send results to Telegram and Twitter within API rate limits'''
+
+    def __init__(self,
+                 bot: telebot.TeleBot,
+                 image_cache_dir: str,
+                 twitter_api_v1: tweepy.API = None,
+                 twitter_client: tweepy.Client = None,
+                 twitter_screen_name: str = None,
+                 twitter_rate_limit: str = None,
+                 twitter_queue_size: int = 10,
+                 twitter_max_age: float = 86400,
+                 retry_delay: float = 10,
+                 ):
+        self.logger = logging.getLogger('bot.publisher')
+        self.bot = bot
+        self.image_cache_dir = image_cache_dir
+        self.twitter_api_v1 = twitter_api_v1
+        self.twitter_client = twitter_client
+        self.twitter_screen_name = twitter_screen_name
+        self.twitter_queue_size = twitter_queue_size
+        # images are removed from the cache after a day, older tweets would fail to upload
+        self.twitter_max_age = twitter_max_age
+        self.retry_delay = retry_delay
+        self.limiters = {
+            'telegram': RateLimiter(TELEGRAM_GLOBAL_LIMITS),
+            'telegram_chat': RateLimiter(TELEGRAM_CHAT_LIMITS),
+            'telegram_group': RateLimiter(TELEGRAM_GROUP_LIMITS),
+            'twitter': RateLimiter(parse_rate_limit(twitter_rate_limit)),
+        }
+        # every API has its own worker so that slow uploads to one do not delay the other
+        self.tasks = {'telegram': [], 'twitter': []}
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def start(self):
+        '''Start the publisher threads'''
+        for api in self.tasks:
+            threading.Thread(target=self._run, args=(api,), daemon=True).start()
+
+    def schedule(self, api, key, send, cost=1, on_success=None, on_error=None, delay=0, ttl=None, name=None):
+        '''Schedule an API call, on_success gets its result and is never retried.
+        Tasks not executed within ttl seconds are dropped'''
+        now = time.monotonic()
+        task = Task(now + delay, next(self.seq), api, key, send, cost, on_success, on_error,
+                    now + ttl if ttl else None, name)
+        with self.cond:
+            self.tasks[api].append(task)
+            self.cond.notify_all()
+
+    def set_twitter_rate_limit(self, value):
+        '''Replace the Twitter budget, value in "count/seconds" format'''
+        self.limiters['twitter'].set_limits(parse_rate_limit(value))
+        with self.cond:
+            self.cond.notify_all()
+
+    def _chat_limiters(self, key):
+        limiters = [self.limiters['telegram_chat']]
+        if is_group(key):
+            limiters.append(self.limiters['telegram_group'])
+        return limiters
+
+    def _delay(self, task):
+        '''Seconds to wait until the task fits into the rate budgets'''
+        if task.api == 'telegram':
+            return max([self.limiters['telegram'].delay(None, task.cost)] +
+                       [limiter.delay(task.key, task.cost) for limiter in self._chat_limiters(task.key)])
+        return self.limiters[task.api].delay(task.key, task.cost)
+
+    def _consume(self, task):
+        if task.api == 'telegram':
+            self.limiters['telegram'].consume(None, task.cost)
+            for limiter in self._chat_limiters(task.key):
+                limiter.consume(task.key, task.cost)
+        else:
+            self.limiters[task.api].consume(task.key, task.cost)
+
+    def _run(self, api):
+        '''Execute scheduled tasks of the API as soon as their budgets allow'''
+        tasks = self.tasks[api]
+        while True:
+            try:
+                with self.cond:
+                    while not tasks:
+                        self.cond.wait()
+                    now = time.monotonic()
+                    for t in [t for t in tasks if t.expires and t.expires < now]:
+                        tasks.remove(t)
+                        self.logger.warning('Dropped expired {}'.format(t.name or t.api))
+                    if not tasks:
+                        continue
+                    task, wait = None, None
+                    for t in sorted(tasks):
+                        delay = max(t.due - now, self._delay(t))
+                        if delay <= 0:
+                            task = t
+                            break
+                        if t.expires:
+                            delay = min(delay, t.expires - now)
+                        wait = delay if wait is None else min(wait, delay)
+                    if task is None:
+                        self.cond.wait(wait)
+                        continue
+                    tasks.remove(task)
+                self._execute(task)
+            except Exception as e:
+                self.logger.exception('Publisher error: {}'.format(e))
+
+    def _execute(self, task):
+        self._consume(task)
+        try:
+            result = task.send()
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after')
+            if e.error_code == 429 and retry_after:
+                self.logger.warning('Telegram rate limit for chat {}, retry after {}s'.format(task.key, retry_after))
+                self.limiters['telegram_chat'].block(task.key, retry_after)
+                self._reschedule(task)
+            else:
+                self._fail(task, e)
+        except tweepy.TooManyRequests as e:
+            seconds = twitter_retry_after(e)
+            self.logger.warning('Twitter rate limit, retry after {}s'.format(seconds))
+            self.limiters['twitter'].block(task.key, seconds)
+            self._reschedule(task)
+        except Exception as e:
+            self._fail(task, e)
+        else:
+            if task.on_success:
+                task.on_success(result)
+
+    def _reschedule(self, task):
+        with self.cond:
+            task.due = time.monotonic()
+            self.tasks[task.api].append(task)
+            self.cond.notify_all()
+
+    def _fail(self, task, error):
+        self.logger.error(error)
+        if task.on_error:
+            task.on_error()
+
+    def publish(self, job, markup=None, twitter=False, retry=False):
+        '''Send the job result to Telegram, album batches are sent without buttons'''
+        batch = job.batch
+        if batch and batch.albums:
+            batch.jobs.append(job)
+            if len(batch.jobs) == batch.albums[0]:
+                batch.albums.pop(0)
+                jobs, batch.jobs = batch.jobs, []
+                self._schedule_album(jobs, retry)
+        else:
+            self._schedule_photo(job, markup, twitter, retry)
+
+    def _schedule_photo(self, job, markup, twitter, retry):
+        def send():
+            self.logger.info('Send image to Telegram...')
+            return self.bot.send_photo(job.target_chat, photo=job.image, caption=caption(job), reply_markup=markup)
+
+        def on_success(resp):
+            self._sent(job, resp)
+            if twitter and self.twitter_api_v1:
+                self._schedule_tweet(job)
+            self._published(job.batch, 1)
+
+        def on_error():
+            if retry:
+                self.schedule('telegram', job.target_chat, send, on_success=on_success, on_error=on_error, delay=self.retry_delay)
+            else:
+                self._published(job.batch, 1)
+
+        self.schedule('telegram', job.target_chat, send, on_success=on_success, on_error=on_error)
+
+    def _schedule_album(self, jobs, retry):
+        target_chat = jobs[0].target_chat
+
+        def send():
+            self.logger.info('Send album of {} images to Telegram...'.format(len(jobs)))
+            media = [telebot.types.InputMediaPhoto(job.image, caption=caption(job), parse_mode='HTML') for job in jobs]
+            return self.bot.send_media_group(target_chat, media)
+
+        def on_success(resp):
+            for job, message in zip(jobs, resp):
+                self._sent(job, message)
+            self._published(jobs[0].batch, len(jobs))
+
+        def on_error():
+            if retry:
+                self.schedule('telegram', target_chat, send, cost=len(jobs), on_success=on_success, on_error=on_error, delay=self.retry_delay)
+            else:
+                self._published(jobs[0].batch, len(jobs))
+
+        self.schedule('telegram', target_chat, send, cost=len(jobs), on_success=on_success, on_error=on_error)
+
+    def _sent(self, job, resp):
+        '''Remember the sent message and cache its image'''
+        self.logger.info("https://t.me/{}/{}".format(resp.chat.username, resp.message_id))
+        job.message_id = resp.message_id
+        image_path = os.path.join(self.image_cache_dir, '{}.jpg'.format(job.message_id))
+        if not os.path.exists(image_path):
+            try:
+                job.image.save(image_path)
+            except Exception as e:
+                self.logger.error('Could not cache image: {}'.format(e))
+
+    def _schedule_tweet(self, job):
+        '''Queue a tweet, keeping only the newest ones when the budget can not keep up'''
+        image_path = os.path.join(self.image_cache_dir, '{}.jpg'.format(job.message_id))
+        with self.cond:
+            pending = self.tasks['twitter']
+            while pending and len(pending) >= self.twitter_queue_size:
+                oldest = min(pending, key=lambda t: t.seq)
+                pending.remove(oldest)
+                self.logger.warning('Dropped {}: Twitter queue is full'.format(oldest.name))
+        self.schedule('twitter', None, lambda: self._tweet(image_path, job.prompt),
+                      on_error=lambda: self.logger.error('Error posting to Twitter'),
+                      ttl=self.twitter_max_age, name='tweet for message {}'.format(job.message_id))
+
+    def _published(self, batch, count):
+        '''Count published jobs and remove the batch status message when done'''
+        if not batch:
+            return
+        batch.published += count
+        if batch.published >= batch.size and batch.status_message:
+            self.schedule('telegram', batch.target_chat,
+                          lambda: self.bot.delete_message(batch.target_chat, batch.status_message))
+
+    def send_status(self, batch, text):
+        '''Send a single status message for the batch'''
+        def on_success(msg):
+            batch.status_message = msg.message_id
+            if batch.published >= batch.size:
+                self.schedule('telegram', batch.target_chat,
+                              lambda: self.bot.delete_message(batch.target_chat, batch.status_message))
+
+        self.schedule('telegram', batch.target_chat,
+                      lambda: self.bot.send_message(batch.target_chat, text, disable_notification=True),
+                      on_success=on_success)
+
+    def _tweet(self, image_path, message):
+        '''Post image to Twitter'''
+        message = message.splitlines()[0] + '\n#AIart #stablediffusion'
+        status = textwrap.shorten(message, width=280, placeholder='...')
+        self.logger.info('Send image to Twitter...')
+        media = self.twitter_api_v1.media_upload(image_path)
+        resp = self.twitter_client.create_tweet(text=status, media_ids=[media.media_id])
+        self.logger.info("https://twitter.com/{}/status/{}".format(self.twitter_screen_name, resp.data['id']))
+
+    def twitter_send(self, image_path, message):
+        '''Post image to Twitter right away if the rate budget allows'''
+        delay = self.limiters['twitter'].delay()
+        if delay > 0:
+            self.logger.warning('Twitter rate limit, next post allowed in {:.0f}s'.format(delay))
+            return False
+        self.limiters['twitter'].consume()
+        try:
+            self._tweet(image_path, message)
+        except tweepy.TooManyRequests as e:
+            self.logger.error(e)
+            self.limiters['twitter'].block(None, twitter_retry_after(e))
+        except Exception as e:
+            self.logger.error(e)
+        else:
+            return True
+        return False
+
+
+def caption(job):
+    return '<code>{}</code>\nseed: <code>{}</code> | scale: <code>{}</code> | steps: <code>{}</code>'.format(job.prompt, job.seed, job.scale, job.steps)
+
+
+def is_group(chat):
+    '''Group and channel ids are negative, channels may also be set by @username'''
+    return str(chat).startswith(('-', '@'))
+
+
+def parse_rate_limit(value):
+    '''Parse rate limit in "count/seconds" format'''
+    if not value:
+        return []
+    count, period = value.split('/', 1)
+    return [(int(count), float(period))]
+
+
+def twitter_retry_after(error):
+    '''Seconds until the Twitter rate limit window resets'''
+    reset = error.response.headers.get('x-rate-limit-reset') if error.response is not None else None
+    if reset:
+        return max(int(reset) - time.time(), 1)
+    return TWITTER_DEFAULT_BACKOFF